@@ -4,5 +4,5 @@ from Cython.Build import cythonize
 
 setup(
     ext_modules=cythonize('src/native_utils.pyx'),
-    include_dirs=[numpy.get_include()], install_requires=['cython', 'numpy', 'tqdm', 'scipy', 'cvxopt']
+    include_dirs=[numpy.get_include()], python_requires='>=3.8', install_requires=['cython', 'numpy', 'pandas', 'tqdm', 'scipy', 'threadpoolctl', 'cvxopt']
 )
@@ -1,8 +1,31 @@
 import os
 import pickle
-from concurrent.futures import ProcessPoolExecutor as Executor
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor as Executor, ThreadPoolExecutor
 
 import numpy as np
+import pandas as pd
+from threadpoolctl import threadpool_limits
+
+cache_dir = 'data/.cache'
+
+# Maps the ASCII code of each letter to its integer encoding.
+_letters_table = np.zeros(256, dtype=np.uint8)
+_letters_table[np.frombuffer(b'ATCG', dtype=np.uint8)] = np.arange(4)
+
+
+def _save_npy(file, array):
+    """
+     Saves the array to a .npy file, through a temporary file so that an interrupted save never leaves it truncated.
+    """
+    tmp_file = '{}.{}.tmp'.format(file, os.getpid())
+    try:
+        with open(tmp_file, 'wb') as f:
+            np.save(f, array)
+        os.replace(tmp_file, file)
+    finally:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
 
 
 def load(X=True, k=0, train=True, embed=False, numeric=True):
@@ -12,25 +35,55 @@ def load(X=True, k=0, train=True, embed=False, numeric=True):
     :param train: whether to load train or test data
     :param embed: whether to load the raw sequences or the embedding
     :param numeric: whether to load sequences of letters or integers
-    :return: the corresponding data array.
-    """
-    data = np.loadtxt(
-        'data/{}{}{}{}.csv'.format('X' if X else 'Y', 'tr' if train else 'te',
-                                   k, '_mat100' if embed else ''),
-        dtype=(float if embed else (str if X else bool)),
-        skiprows=(0 if embed else 1),
-        usecols=(None if embed else 1),
-        delimiter=(' ' if embed else ','))
-    if X and not embed and numeric:
-        letters = np.array(list('ATCG'))
-        data = np.array([list(s) for s in data])
-        array = np.zeros(data.shape)
-        for i, l in enumerate(letters):
-            array[data == l] = i
-        data = array
+    :return: the corresponding data array (labels are 0/1 int8).
+
+    N.B. Caches the integer sequences and the embeddings to the disk, to skip parsing the csv in future loads.
+    They are returned as read-only memory-mapped arrays. A cache older than its csv file is recomputed.
+    """
+    file_name = '{}{}{}{}'.format('X' if X else 'Y', 'tr' if train else 'te', k, '_mat100' if embed else '')
+    path = 'data/{}.csv'.format(file_name)
+    decode = X and not embed and numeric
+    cached = embed or decode
+    cache_file = '{}/{}.{}.npy'.format(cache_dir, file_name, 'f32' if embed else 'u8')
+    if cached and os.path.exists(cache_file) and os.path.getmtime(cache_file) >= os.path.getmtime(path):
+        return np.load(cache_file, mmap_mode='r')
+
+    if embed:
+        data = pd.read_csv(path, sep=' ', header=None, dtype=np.float32, engine='c').to_numpy()
+    else:
+        data = pd.read_csv(path, usecols=[1], dtype=(str if X else np.int8), engine='c').iloc[:, 0]
+        data = data.to_numpy(dtype=(str if X else np.int8))
+    if decode:
+        data = data.astype(np.bytes_)
+        data = _letters_table[data.view(np.uint8).reshape(len(data), data.itemsize)]
+    if cached:
+        os.makedirs(cache_dir, exist_ok=True)
+        _save_npy(cache_file, data)
+        data = np.load(cache_file, mmap_mode='r')
     return data
 
 
+def available_cpus():
+    """
+     Returns the number of CPUs the current process is allowed to run on.
+    """
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count()
+
+
+def process_pool(max_workers):
+    """
+     Returns a pool of max_workers processes, among which the available CPUs are split for BLAS threads,
+     to avoid oversubscribing them.
+
+     N.B. Workers are forked with BLAS already loaded, so its threads are limited with threadpoolctl
+     rather than with environment variables.
+    """
+    threads = max(1, available_cpus() // max_workers)
+    return Executor(max_workers=max_workers, initializer=threadpool_limits, initargs=(threads,))
+
+
 n_datasets = 3
 train_Ys = [load(X=False, k=k) for k in range(n_datasets)]
 
@@ -44,68 +97,135 @@ def shuffle(*arrays):
     return [a[indices] for a in arrays]
 
 
-def k_folds_indices(n, k):
+@lru_cache(maxsize=256)
+def _seeded_permutation(n, seed):
+    """
+     Returns a read-only random permutation of n elements, drawn once per seed.
+    """
+    indices = np.random.RandomState(seed).permutation(n)
+    indices.flags.writeable = False
+    return indices
+
+
+def permutation(n, seed=None):
+    """
+     Returns a random permutation of n elements.
+     If seed is not None, the permutation is deterministic, and only drawn once (it is then read-only).
+    """
+    return np.random.permutation(n) if seed is None else _seeded_permutation(n, seed)
+
+
+def k_folds_indices(n, k, seed=None):
     """
      Return k pairs (train_inds, valid_inds) of arrays containing the training and validation indices for each split.
+     If seed is not None, the splits are deterministic and their permutation is only drawn once.
     """
     assert (n % k == 0)
     m = n // k
-    indices = np.random.permutation(n)
+    indices = permutation(n, seed)
+    train_mask = np.ones(n, dtype=bool)
 
     folds = []
     for i in range(k):
-        folds.append((np.concatenate((indices[:i * m], indices[(i + 1) * m:])),
-                      indices[i * m:(i + 1) * m]))
+        train_mask[i * m:(i + 1) * m] = False
+        folds.append((indices[train_mask], indices[i * m:(i + 1) * m]))
+        train_mask[i * m:(i + 1) * m] = True
     return folds
 
 
-def precomputed_kernels(kernel, name, numeric=True, max_workers=6, **params):
+def _to_float32(kernels):
+    """
+     Casts the kernel arrays of a (train_Ks, test_Ks) tuple to float32, which halves their memory traffic.
+    """
+    return tuple([K.astype(np.float32, copy=False) if isinstance(K, np.ndarray) else K for K in Ks] for Ks in kernels)
+
+
+def precomputed_kernels(kernel, name, numeric=True, max_workers=None, backend='processes', **params):
     """
     :param kernel: a function k(X, Y) that computes the kernels
     :param name: a unique name to represent the kernel
     :param numeric whether to load that data as numbers or strings
-    :param max_workers parallel workers
+    :param max_workers parallel workers, defaults to one per kernel (within the available CPUs)
+    :param backend 'processes' or 'threads'. Threads share the data and kernels without pickling them,
+     but only run in parallel when the kernel releases the GIL (NumPy/BLAS-bound, or parallel on its own).
     :param params kernel parameters
     :return a (train_Ks, test_Ks) tuple with kernels for all train and test datasets
 
     N.B. Stores the computed kernel to the disk, to reduce future computations.
+    Kernel matrices are stored in float32 as .npy files, memory-mapped when loaded again.
     """
     kernels_dir = 'kernels'
     if not os.path.isdir(kernels_dir):
         os.mkdir(kernels_dir)
     file_name = '{}/{}'.format(kernels_dir, name)
+    npy_files = [['{}.{}.{}.npy'.format(file_name, split, k) for k in range(n_datasets)] for split in ('train', 'test')]
+
+    if all(os.path.exists(f) for files in npy_files for f in files):
+        return tuple([np.load(f, mmap_mode='r') for f in files] for files in npy_files)
 
     if os.path.exists(file_name):
         with open(file_name, 'rb') as file:
-            kernels = pickle.load(file)
+            kernels = _to_float32(pickle.load(file))
     else:
         train_Xs = [load(k=k, numeric=numeric) for k in range(n_datasets)]
         test_Xs = [load(k=k, train=False, numeric=numeric) for k in range(n_datasets)]
 
-        with Executor(max_workers=max_workers) as executor:
-            train_futures = [executor.submit(kernel, train_X, **params) for train_X in train_Xs]
-            test_futures = [executor.submit(kernel, test_X, train_X, **params) for (test_X, train_X) in zip(test_Xs, train_Xs)]
-            train_Ks = [future.result() for future in train_futures]
-            test_Ks = [future.result() for future in test_futures]
-        kernels = train_Ks, test_Ks
-        with open(file_name, 'wb') as file:
-            pickle.dump(kernels, file)
+        if backend not in ('processes', 'threads'):
+            raise ValueError("Unknown backend: {}.".format(backend))
+
+        if max_workers is None:
+            max_workers = min(2 * n_datasets, available_cpus())
+
+        if max_workers == 1:
+            # Computes in the calling thread, e.g. for kernels starting their own process pools.
+            train_Ks = [kernel(train_X, **params) for train_X in train_Xs]
+            test_Ks = [kernel(test_X, train_X, **params) for (test_X, train_X) in zip(test_Xs, train_Xs)]
+        else:
+            with (process_pool if backend == 'processes' else ThreadPoolExecutor)(max_workers) as executor:
+                train_futures = [executor.submit(kernel, train_X, **params) for train_X in train_Xs]
+                test_futures = [executor.submit(kernel, test_X, train_X, **params)
+                                for (test_X, train_X) in zip(test_Xs, train_Xs)]
+                train_Ks = [future.result() for future in train_futures]
+                test_Ks = [future.result() for future in test_futures]
+        kernels = _to_float32((train_Ks, test_Ks))
+
+    if all(isinstance(K, np.ndarray) for Ks in kernels for K in Ks):
+        # Also converts legacy pickled kernels.
+        for Ks, files in zip(kernels, npy_files):
+            for K, f in zip(Ks, files):
+                _save_npy(f, K)
+        kernels = tuple([np.load(f, mmap_mode='r') for f in files] for files in npy_files)
+    elif not os.path.exists(file_name):
+        # Kernels that are not plain arrays (e.g. tensors) are pickled, through a temporary file.
+        tmp_file = '{}.{}.tmp'.format(file_name, os.getpid())
+        with open(tmp_file, 'wb') as file:
+            pickle.dump(kernels, file, protocol=5)
+        os.replace(tmp_file, file_name)
 
     return kernels
 
 
-def transform_kernels(kernels, transform, **params):
+def transform_kernels(kernels, transform, max_workers=None, **params):
     """
     :param kernels: a list of (train_Ks, test_Ks) tuples
     :param transform: a function that maps len(kernels) kernels to one kernel
+    :param max_workers parallel workers, defaults to one per kernel (within the available CPUs)
     :return a (train_Ks, test_Ks) tuple with kernels for all train and test datasets
+
+    N.B. Transforms of all datasets are computed in parallel threads, as they are usually NumPy-bound
+    (and often lambdas, which cannot be sent to other processes).
     """
     train, test = zip(*kernels)
+    if max_workers is None:
+        max_workers = min(2 * len(train[0]), available_cpus())
 
-    return (
-        [transform(i, *ks, **params) for i, ks in enumerate(zip(*train))],
-        [transform(i, *ks, **params) for i, ks in enumerate(zip(*test))],
-    )
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        train_futures = [executor.submit(transform, i, *ks, **params) for i, ks in enumerate(zip(*train))]
+        test_futures = [executor.submit(transform, i, *ks, **params) for i, ks in enumerate(zip(*test))]
+        return (
+            [future.result() for future in train_futures],
+            [future.result() for future in test_futures],
+        )
 
 
 def save_predictions(predictions, file):
@@ -117,6 +237,5 @@ def save_predictions(predictions, file):
     if not os.path.isdir(predictions_dir):
         os.mkdir(predictions_dir)
     predictions = np.concatenate(predictions)
-    np.savetxt('{}/{}.csv'.format(predictions_dir, file),
-               np.stack([np.arange(len(predictions)), predictions], axis=1),
-               header='Id,Bound', comments='', fmt='%d', delimiter=',')
\ No newline at end of file
+    pd.DataFrame({'Id': np.arange(len(predictions)), 'Bound': predictions.astype(np.int8)}).to_csv(
+        '{}/{}.csv'.format(predictions_dir, file), index=False)
@@ -1,62 +1,197 @@
 import numpy as np
-from concurrent.futures import ProcessPoolExecutor as Executor
-from data import train_Ys, k_folds_indices, save_predictions
+from contextlib import contextmanager, ExitStack
+from multiprocessing.shared_memory import SharedMemory
+from data import train_Ys, save_predictions, available_cpus, process_pool, permutation
 
 
-def evaluate(classifier, K, Y, folds=5, repeats=1):
+@contextmanager
+def _shared_array(array):
+    """
+     Copies the array to shared memory, for the time of the context.
+     Yields a (name, shape, dtype) reference, from which workers can view the array without copying it.
+    """
+    array = np.asarray(array)
+    shm = SharedMemory(create=True, size=max(array.nbytes, 1))
+    try:
+        view = np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)
+        view[...] = array
+        del view
+        yield shm.name, array.shape, array.dtype.str
+    finally:
+        shm.close()
+        shm.unlink()
+
+
+@contextmanager
+def _attached_array(ref):
+    """
+     Yields a read-only view of a shared array from its reference, for the time of the context.
+    """
+    name, shape, dtype = ref
+    shm = SharedMemory(name=name)
+    array = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+    array.flags.writeable = False
+    try:
+        yield array
+    finally:
+        # The buffer can only be closed once no view references it.
+        del array
+        shm.close()
+
+
+def _run_fold(classifiers, K_ref, Y, folds, i):
+    """
+     Fits each of the classifiers on the i-th fold of the shared kernel K_ref, whose samples are randomly permuted:
+     the validation samples of the fold are then the i-th contiguous block, and the train samples the other ones.
+     The fold kernels are copied once from these blocks, and reused by all the classifiers.
+     Validation and train predictions are computed at once, on the stacked kernel rows.
+     Returns, for each classifier, the number of correct validation predictions and the train accuracy.
+    """
+    with _attached_array(K_ref) as K:
+        N = len(K)
+        m = N // folds
+        low, high = i * m, (i + 1) * m
+
+        # Rows are the validation then train samples, columns the train samples.
+        K_pred = np.empty((N, N - m), dtype=K.dtype)
+        for rows, block in ((slice(0, m), slice(low, high)),
+                            (slice(m, m + low), slice(0, low)),
+                            (slice(m + low, N), slice(high, N))):
+            K_pred[rows, :low] = K[block, :low]
+            K_pred[rows, low:] = K[block, high:]
+        del K
+
+    K_train = K_pred[m:]
+    Y_train = np.concatenate((Y[:low], Y[high:]))
+    Y_valid = Y[low:high]
+
+    results = []
+    for classifier in classifiers:
+        classifier.fit(K_train, Y_train)
+        predictions = classifier.predict(K_pred)
+        valid_correct = np.count_nonzero(predictions[:m] == Y_valid)
+        train_acc = np.count_nonzero(predictions[m:] == Y_train) / len(Y_train)
+        results.append((valid_correct, train_acc))
+    return results
+
+
+def _scores(scores, N):
+    """
+     Reduces scores of shape (repeats, folds, classifiers, 2) to a list with, for each classifier:
+        (valid_scores_mean, valid_scores_std, train_scores_mean, train_scores_std)
+    """
+    scores = np.array(scores)
+    valid_scores = scores[..., 0].sum(axis=1) / N
+    train_scores = scores[..., 1].mean(axis=1)
+
+    return list(zip(valid_scores.mean(axis=0), valid_scores.std(axis=0),
+                    train_scores.mean(axis=0), train_scores.std(axis=0)))
+
+
+def _cross_validate(executor, classifiers, Ks, Ys, folds, repeats, permutations=None, seed=None):
+    """
+     Cross-validates the list of classifiers of each data set on its kernel and labels,
+     the (data set, fold) fits being run in parallel. Each task fits all the classifiers of a data set on the same fold.
+
+     Repetitions are run one after the other. For each of them, the kernels permuted by a random permutation
+     (or the given ones) are shared, so that the folds are contiguous blocks;
+     only one permuted kernel per data set is held in shared memory at a time.
+    :param permutations: None, or for each data set a list of the permutations of each repetition
+    :param seed: if not None, repetition r uses the cached permutation of seed + r
+    :return for each data set, a list with for each classifier:
+        (valid_scores_mean, valid_scores_std, train_scores_mean, train_scores_std)
+    """
+    assert all(len(K) % folds == 0 for K in Ks)
+
+    scores = [[] for _ in Ks]
+    for r in range(repeats):
+        with ExitStack() as stack:
+            futures = []
+            for d, (K, Y, dataset_classifiers) in enumerate(zip(Ks, Ys, classifiers)):
+                if permutations is None:
+                    perm = permutation(len(K), None if seed is None else seed + r)
+                else:
+                    perm = permutations[d][r]
+                K_ref = stack.enter_context(_shared_array(K[perm][:, perm]))
+                futures.append([executor.submit(_run_fold, dataset_classifiers, K_ref, Y[perm], folds, i)
+                                for i in range(folds)])
+
+            for dataset_scores, dataset_futures in zip(scores, futures):
+                dataset_scores.append([future.result() for future in dataset_futures])
+
+    return [_scores(dataset_scores, len(K)) for K, dataset_scores in zip(Ks, scores)]
+
+
+def _best_params(params, results):
+    """
+     Selects the parameters maximizing the mean minus the std of the validation score.
+    """
+    results = np.array(results)
+    return params[np.argmax(results[:, 0] - results[:, 1])]
+
+
+def evaluate(classifier, K, Y, folds=5, repeats=1, max_workers=None, permutations=None, seed=None):
     """
     :param classifier: classifier to evaluate
     :param K: precomputed kernel matrix of shape (n_samples, n_samples)
     :param Y: training labels of shape (n_samples, )
     :param folds: number of folds to use
     :param repeats: number of repetitions of the k-fold evaluation
+    :param max_workers: parallel workers, defaults to one per fold (within the available CPUs)
+    :param permutations: for each repetition, a permutation of the samples whose contiguous blocks are the folds,
+     to use instead of random ones
+    :param seed: seed of the permutations, for reproducible folds (random if None)
 
-    Evaluates the classifier using cross-validation.
+    Evaluates the classifier using cross-validation, the folds being fitted in parallel.
     Returns the mean and std of the validation and train scores over the repetitions:
         (valid_scores_mean, valid_scores_std, train_scores_mean, train_scores_std)
     """
+    if max_workers is None:
+        max_workers = min(folds, available_cpus())
 
-    N = len(K)
-    valid_scores = []
-    train_scores = []
-    for i in range(repeats):
-        valid_score = 0
-        train_score = 0
-        for train_inds, valid_inds in k_folds_indices(N, folds):
-            classifier.fit(K[np.ix_(train_inds, train_inds)], Y[train_inds])
+    with process_pool(max_workers) as executor:
+        return _cross_validate(executor, [[classifier]], [K], [Y], folds, repeats,
+                               None if permutations is None else [permutations], seed)[0][0]
 
-            valid_score += (classifier.predict(K[np.ix_(
-                valid_inds, train_inds)]) == Y[valid_inds]).sum()
-            train_score += (classifier.predict(K[np.ix_(
-                train_inds, train_inds)]) == Y[train_inds]).mean()
 
-        valid_scores.append(valid_score / N)
-        train_scores.append(train_score / folds)
+def grid_searches(model, params, Ks, Ys, folds=5, repeats=1, executor=None, seed=None):
+    """
+     Grid search on params using k-fold cross validation, for each of the data sets.
+     All the parameters are evaluated on the same folds, the (data set, fold) fits being run in parallel.
+    :param model: a function that instantiates a model given parameters from params
+    :param params: list of parameters to try
+    :param Ks the kernels of the data sets
+    :param Ys the labels of the data sets
+    :param folds number of folds for validation
+    :param executor a process pool to run the fits on, a new one is used if None
+    :param seed seed of the cross validation folds, random if None
+    :return for each data set, selected parameters and associated performance
+    """
+    if executor is None:
+        with process_pool(available_cpus()) as executor:
+            return grid_searches(model, params, Ks, Ys, folds, repeats, executor, seed)
 
-    valid_scores = np.array(valid_scores)
-    train_scores = np.array(train_scores)
+    results = _cross_validate(executor, [[model(**p) for p in params] for _ in Ks], Ks, Ys, folds, repeats, seed=seed)
+    best_params = [_best_params(params, dataset_results) for dataset_results in results]
 
-    return valid_scores.mean(), valid_scores.std(), train_scores.mean(), train_scores.std()
+    results = _cross_validate(executor, [[model(**p)] for p in best_params], Ks, Ys, 20, repeats, seed=seed)
+    return [(p, np.array(dataset_results[0])) for p, dataset_results in zip(best_params, results)]
 
 
-def grid_search(model, params, K, Y, folds=5, repeats=1):
+def grid_search(model, params, K, Y, folds=5, repeats=1, executor=None, seed=None):
     """
      Grid search on params using k-fold cross validation.
+     All the parameters are evaluated on the same folds, the fits of the folds being run in parallel.
     :param model: a function that instantiates a model given parameters from params
     :param params: list of parameters to try
     :param K the kernel
     :param Y the labels
     :param folds number of folds for validation
+    :param executor a process pool to run the fits on, a new one is used if None
+    :param seed seed of the cross validation folds, random if None
     :return selected parameters and associated performance
     """
-    results = []
-    for p in params:
-        results.append(np.array(evaluate(model(**p), K, Y, folds=folds, repeats=repeats)))
-
-    results = np.array(results)
-    p = params[np.argmax(results[:, 0] - results[:, 1])]
-
-    return p, np.array(evaluate(model(**p), K, Y, folds=20, repeats=repeats))
+    return grid_searches(model, params, [K], [Y], folds, repeats, executor, seed)[0]
 
 
 def final_train(model, p, K_train, Y_train, K_test):
@@ -73,7 +208,7 @@ def final_train(model, p, K_train, Y_train, K_test):
     return m.predict(K_test)
 
 
-def svm_kernels(kernels, model, Cs=10. ** np.arange(-3, 4), prediction_file=None, repeats=1, **params):
+def svm_kernels(kernels, model, Cs=10. ** np.arange(-3, 4), prediction_file=None, repeats=1, seed=None, **params):
     """
     Evaluates a SVM model with the specified kernels.
     - First, optimizes C value using a grid search for each of the data sets.
@@ -85,6 +220,7 @@ def svm_kernels(kernels, model, Cs=10. ** np.arange(-3, 4), prediction_file=None
     :param Cs: values of C to use in the grid search
     :param prediction_file: file to save the predictions to
     :param repeats: number of repetitions of the k-fold cross validations.
+    :param seed: seed of the cross validation folds, for reproducible folds (random if None).
     :param params: parameters of the model (excluding C)
     :return: detailed validation score over each of the 3 data sets.
     """
@@ -94,10 +230,14 @@ def svm_kernels(kernels, model, Cs=10. ** np.arange(-3, 4), prediction_file=None
     total_perf = np.zeros(4)
     full_results = []
 
-    with Executor(max_workers=3) as executor:
-        futures = [executor.submit(grid_search, model, params, K, Y, repeats=repeats) for K, Y in
-                   zip(train_Ks, train_Ys)]
-        res = [future.result() for future in futures]
+    # A single pool runs the fits of all data sets and folds.
+    with process_pool(available_cpus()) as executor:
+        res = grid_searches(model, params, train_Ks, train_Ys, repeats=repeats, executor=executor, seed=seed)
+
+        if prediction_file is not None:
+            futures = [executor.submit(final_train, model, p, K, Y, K_test) for K, Y, K_test, (p, _) in
+                       zip(train_Ks, train_Ys, test_Ks, res)]
+            predictions = [future.result() for future in futures]
 
     for p, performance in res:
         total_perf += performance
@@ -106,10 +246,6 @@ def svm_kernels(kernels, model, Cs=10. ** np.arange(-3, 4), prediction_file=None
         full_results.append(performance)
 
     if prediction_file is not None:
-        with Executor(max_workers=3) as executor:
-            futures = [executor.submit(final_train, model, p, K, Y, K_test) for K, Y, K_test, (p, _) in
-                       zip(train_Ks, train_Ys, test_Ks, res)]
-            predictions = [future.result() for future in futures]
         save_predictions(predictions, prediction_file)
 
     total_percentages = 100 * total_perf / 3
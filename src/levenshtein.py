@@ -4,7 +4,6 @@ import autograd as ag
 from tqdm import tqdm as tqdm_notebook
 import numpy as np
 from concurrent.futures import ProcessPoolExecutor as Executor
-import multiprocessing
 
 from data import precomputed_kernels, transform_kernels
 
@@ -21,7 +20,7 @@ def parallel_dists(dist_fn, weights, X, Y=None, tqdm=False):
 
     d = np.zeros((len(X), len(Y)), dtype=np.float32)
     g = np.empty((len(weights), len(X), len(Y)), dtype=np.float32)
-    with Executor(max_workers=multiprocessing.cpu_count()) as executor:
+    with Executor(max_workers=data.available_cpus()) as executor:
         iterator = enumerate(executor.map(dist_fn, X.data, Ys, [weights.data] * len(X)))
         if tqdm:
             iterator = tqdm_notebook(iterator, total=len(X))
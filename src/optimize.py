@@ -115,6 +115,7 @@ if __name__ == '__main__':
         os.chdir('..')
     from spectrum import *
     from evaluation import *
+    from data import k_folds_indices, train_Ys
 
     def run():
         spectrum_kernels = []
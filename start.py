@@ -165,5 +165,6 @@ if __name__ == '__main__':
                      out_weights_file='out_weights',
 
                      model=svm.SVCCoordinate,       # SVM model
+                     seed=0,                        # Seed of the cross validation folds (None for random folds).
                      intercept=1.,
                      loss='hinge')